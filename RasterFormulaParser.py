@@ -0,0 +1,163 @@
+import ast, re
+
+# Numbers, identifiers and single character operators, whitespace is skipped
+_TOKEN_RE = re.compile(r"\s*(?:(\d+\.?\d*(?:[eE][-+]?\d+)?|\.\d+(?:[eE][-+]?\d+)?)|([A-Za-z_]\w*)|(\S))")
+
+_BINARY_OPERATORS = {"+": ast.Add, "-": ast.Sub, "*": ast.Mult, "/": ast.Div}
+
+# Operator symbols and precedences of the raster calculator, unary operators binding tighter than ^
+_OPERATOR_SYMBOLS = {ast.Add: "+", ast.Sub: "-", ast.Mult: "*", ast.Div: "/", ast.Pow: "^", ast.UAdd: "+", ast.USub: "-"}
+_OPERATOR_PRECEDENCES = {ast.Add: 1, ast.Sub: 1, ast.Mult: 2, ast.Div: 2, ast.Pow: 3}
+_UNARY_PRECEDENCE = 4
+_ATOM_PRECEDENCE = 5
+
+
+def parse_formula(formula: str) -> ast.Expression:
+    """
+    Parses a raster calculator formula into a Python expression AST in a single pass.
+    The formula is made of numbers, band names, function calls such as func_band_max(R),
+    parentheses and the + - * / ^ operators, `^` being the power operator (ast.Pow).
+    Operators follow the raster calculator precedence, so -R ^ 2 is parsed as (-R) ^ 2.
+
+    Raises:
+        ValueError: If the formula is not valid.
+    """
+    return ast.fix_missing_locations(ast.Expression(_FormulaParser(formula).parse()))
+
+
+def unparse_formula(tree: ast.AST) -> str:
+    """
+    Serializes a formula AST back into raster calculator syntax. Python and the raster calculator disagree
+    on the precedence of unary minus and ^, so the operands of ^ and of unary operators are parenthesized
+    unless they are numbers, band names or function calls, e.g. -(R ^ 2), (-R) ^ 2 and R ^ (2 ^ 3).
+    """
+    if isinstance(tree, ast.Expression):
+        tree = tree.body
+    return _unparse_node(tree)[0]
+
+
+def _unparse_node(node: ast.expr) -> tuple[str, int]:
+    """
+    Returns the raster calculator syntax of a node and the precedence of its outermost operator.
+    """
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return repr(node.value), _UNARY_PRECEDENCE if node.value < 0 else _ATOM_PRECEDENCE
+    if isinstance(node, ast.Name):
+        return node.id, _ATOM_PRECEDENCE
+    if isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and not node.keywords:
+        return f"{node.func.id}({', '.join(_unparse_node(arg)[0] for arg in node.args)})", _ATOM_PRECEDENCE
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _OPERATOR_SYMBOLS:
+        return _OPERATOR_SYMBOLS[type(node.op)] + _unparse_operand(node.operand, _ATOM_PRECEDENCE), _UNARY_PRECEDENCE
+    if isinstance(node, ast.BinOp) and type(node.op) in _OPERATOR_PRECEDENCES:
+        precedence = _OPERATOR_PRECEDENCES[type(node.op)]
+        if isinstance(node.op, ast.Pow):
+            left, right = _unparse_operand(node.left, _ATOM_PRECEDENCE), _unparse_operand(node.right, _ATOM_PRECEDENCE)
+        else:
+            # Left associative, the right operand needs parentheses at the same precedence, e.g. a - (b - c)
+            left, right = _unparse_operand(node.left, precedence), _unparse_operand(node.right, precedence + 1)
+        return f"{left} {_OPERATOR_SYMBOLS[type(node.op)]} {right}", precedence
+    raise ValueError(f"Unsupported formula element: {ast.dump(node)}")
+
+
+def _unparse_operand(node: ast.expr, minimum_precedence: int) -> str:
+    """
+    Returns the raster calculator syntax of an operand, parenthesized when it binds looser than required.
+    """
+    text, precedence = _unparse_node(node)
+    return text if precedence >= minimum_precedence else f"({text})"
+
+
+class _FormulaParser:
+    """
+    Recursive-descent parser of raster calculator formulas, following the raster calculator operator
+    precedence, where unary operators bind tighter than the right associative ^:
+
+        expression := term (("+" | "-") term)*
+        term       := power (("*" | "/") power)*
+        power      := unary ("^" power)?
+        unary      := ("+" | "-") unary | atom
+        atom       := NUMBER | NAME ("(" [expression ("," expression)*] ")")? | "(" expression ")"
+    """
+    def __init__(self, formula: str):
+        self.formula = formula
+        # (group number, text, offset) tokens, group 1 being numbers, 2 identifiers and 3 operators
+        self.tokens = [(match.lastindex, match.group(match.lastindex), match.start(match.lastindex)) for match in _TOKEN_RE.finditer(formula)]
+        self.tokens.append((None, None, len(formula)))
+        self.position = 0
+
+    def parse(self) -> ast.expr:
+        node = self.__expression()
+        if self.__peek() is not None:
+            self.__fail()
+        return node
+
+    def __peek(self):
+        return self.tokens[self.position][1]
+
+    def __next(self):
+        token = self.tokens[self.position]
+        self.position += 1
+        return token
+
+    def __expect(self, value: str):
+        if self.__peek() != value:
+            self.__fail()
+        self.position += 1
+
+    def __fail(self):
+        _, value, offset = self.tokens[self.position]
+        found = f"'{value}'" if value is not None else "end of formula"
+        raise ValueError(f"Invalid formula '{self.formula}': unexpected {found} at position {offset}")
+
+    def __expression(self) -> ast.expr:
+        node = self.__term()
+        while self.__peek() in ("+", "-"):
+            operator = _BINARY_OPERATORS[self.__next()[1]]
+            node = ast.BinOp(node, operator(), self.__term())
+        return node
+
+    def __term(self) -> ast.expr:
+        node = self.__power()
+        while self.__peek() in ("*", "/"):
+            operator = _BINARY_OPERATORS[self.__next()[1]]
+            node = ast.BinOp(node, operator(), self.__power())
+        return node
+
+    def __power(self) -> ast.expr:
+        node = self.__unary()
+        if self.__peek() == "^":
+            self.position += 1
+            # Right associative: a ^ b ^ c is a ^ (b ^ c)
+            node = ast.BinOp(node, ast.Pow(), self.__power())
+        return node
+
+    def __unary(self) -> ast.expr:
+        if self.__peek() in ("+", "-"):
+            operator = ast.UAdd if self.__next()[1] == "+" else ast.USub
+            return ast.UnaryOp(operator(), self.__unary())
+        return self.__atom()
+
+    def __atom(self) -> ast.expr:
+        kind, value, _ = self.tokens[self.position]
+        if kind == 1:
+            self.position += 1
+            return ast.Constant(float(value) if any(c in value for c in ".eE") else int(value))
+        if kind == 2:
+            self.position += 1
+            if self.__peek() != "(":
+                return ast.Name(value, ast.Load())
+            self.position += 1
+            args = []
+            if self.__peek() != ")":
+                args.append(self.__expression())
+                while self.__peek() == ",":
+                    self.position += 1
+                    args.append(self.__expression())
+            self.__expect(")")
+            return ast.Call(ast.Name(value, ast.Load()), args, [])
+        if value == "(":
+            self.position += 1
+            node = self.__expression()
+            self.__expect(")")
+            return node
+        self.__fail()
@@ -1,8 +1,34 @@
-from qgis.core import QgsApplication, QgsRasterLayer, QgsProcessingException
-from RasterIndexCalculatorTask import RasterIndexCalculatorTask
+from qgis.core import QgsApplication, QgsRasterLayer, QgsProcessingException, QgsRasterBandStats
+from RasterIndexCalculatorTask import RasterIndexCalculatorTask, GDAL_BAND_ALGEBRA_AVAILABLE
+from RasterMultiIndexTask import RasterMultiIndexTask
 from RasterSaveTask import RasterSaveTask
+from RasterFormulaParser import parse_formula, unparse_formula
 from osgeo import gdal
-import time, os, logging, re
+import time, os, logging, ast, copy, threading, functools
+
+log = logging.getLogger(__name__)
+
+
+class _IndexFunctionInliner(ast.NodeTransformer):
+    """
+    Replaces func_index(<index>) with the formula of the index, recursively.
+    """
+    def __init__(self, parsed_formulas: dict[str, ast.Expression]):
+        self.parsed_formulas = parsed_formulas
+
+    def visit_Call(self, node: ast.Call):
+        if isinstance(node.func, ast.Name) and node.func.id == "func_index":
+            return self.visit(copy.deepcopy(self.parsed_formulas[ast.unparse(node.args[0])].body))
+        return self.generic_visit(node)
+
+
+def _flatten_formulas(parsed_formulas: dict[str, ast.Expression]) -> dict[str, str]:
+    """
+    Inlines every func_index reference between the formulas. func_index does not depend on the raster,
+    so only the func_band_* functions are left to resolve per raster.
+    """
+    inliner = _IndexFunctionInliner(parsed_formulas)
+    return {index: unparse_formula(inliner.visit(copy.deepcopy(tree))) for index, tree in parsed_formulas.items()}
 
 
 class RasterIndexCalculator:
@@ -40,8 +66,35 @@ class RasterIndexCalculator:
         "NGRDI_stary": "(G - R) / (G + R)",
         "ExGRnorm_george": "(func_index(ExGR_george) + 2.4) / 5.4"
     }
+    # Indices with a bounded range that can be stored as integers: (data type, scale, offset),
+    # stored value = round(value * scale + offset). [-1, 1] ranges use Int16, [0, 1] ranges use Byte.
+    indices_quantization = {
+        "Rnorm": (gdal.GDT_Byte, 254.0, 0.0),
+        "Gnorm": (gdal.GDT_Byte, 254.0, 0.0),
+        "Bnorm": (gdal.GDT_Byte, 254.0, 0.0),
+        "Rrefl_stary": (gdal.GDT_Byte, 254.0, 0.0),
+        "Grefl_stary": (gdal.GDT_Byte, 254.0, 0.0),
+        "Brefl_stary": (gdal.GDT_Byte, 254.0, 0.0),
+        "NGRDI_wernette": (gdal.GDT_Int16, 10000.0, 0.0),
+        "MGRVI_wernette": (gdal.GDT_Int16, 10000.0, 0.0),
+        "GLI_wernette": (gdal.GDT_Int16, 10000.0, 0.0),
+        "GLI_stary": (gdal.GDT_Int16, 10000.0, 0.0),
+        "RGBVI_stary": (gdal.GDT_Int16, 10000.0, 0.0),
+        "IKAW_wernette": (gdal.GDT_Int16, 10000.0, 0.0),
+        "GLA_wernette": (gdal.GDT_Int16, 10000.0, 0.0),
+        "Gperc_stary": (gdal.GDT_Byte, 254.0, 0.0),
+        "r_george": (gdal.GDT_Byte, 254.0, 0.0),
+        "g_george": (gdal.GDT_Byte, 254.0, 0.0),
+        "b_george": (gdal.GDT_Byte, 254.0, 0.0),
+        "NGRDI_stary": (gdal.GDT_Int16, 10000.0, 0.0),
+        "ExGRnorm_george": (gdal.GDT_Byte, 254.0, 0.0),
+    }
+    # Formulas are parsed once, func_index references are spliced in from here
+    parsed_formulas = {index: parse_formula(formula) for index, formula in indices_formulas.items()}
+    # Formulas with all func_index references inlined
+    indices_formulas_flat = _flatten_formulas(parsed_formulas)
 
-    def __init__(self, input_files: list[str], selected_indices: str, band_mapping: dict[str, int], output_dir: str="/vsimem/", max_memory_usage:int=1024, max_active_tasks:int=5):
+    def __init__(self, input_files: list[str], selected_indices: str, band_mapping: dict[str, int], output_dir: str="/vsimem/", max_memory_usage:int=1024, max_active_tasks:int=5, approximate_statistics:bool=False, backend:str="auto", quantize_outputs:bool=False, cog_output:bool=False):
         self.input_files = input_files
         self.selected_indices = selected_indices.split(",")
         self.band_mapping = band_mapping
@@ -51,13 +104,20 @@ class RasterIndexCalculator:
         self.total_time = 0.0
         self.max_memory_usage = max_memory_usage
         self.max_active_tasks = max_active_tasks
-        self.active_tasks:list[RasterIndexCalculatorTask] = []
+        self.active_tasks:list[RasterIndexCalculatorTask | RasterMultiIndexTask] = []
         self.saving_tasks_queue:list[RasterIndexCalculatorTask] = []
         self.memory_usage = 0
         self.number_of_tasks = len(input_files) * len(self.selected_indices)
         self.progress = 0
         self.progress_step = self.__calculate_progress_step()
-        self.raster_save_task = RasterSaveTask()
+        # Set by tasks when a calculation or saving finishes, wakes up the scheduler in execute()
+        self._completion_event = threading.Event()
+        self.raster_save_task = RasterSaveTask(completion_event=self._completion_event)
+        self.approximate_statistics = approximate_statistics
+        self.backend = backend
+        self.quantize_outputs = quantize_outputs
+        self.cog_output = cog_output
+        self._band_stats_cache: dict[tuple[str, int], QgsRasterBandStats] = {}
 
         gdal.UseExceptions()
         #self.load_raster_layers()
@@ -70,159 +130,273 @@ class RasterIndexCalculator:
     def load_raster_layer(file):
         raster_layer = QgsRasterLayer(file, os.path.basename(file))
         if not raster_layer.isValid():
-            logging.critical(f"Invalid raster file: {file}")
+            log.critical("Invalid raster file: %s", file)
             raise QgsProcessingException(f"Invalid raster file: {file}")
         return raster_layer
 
     def __validate_indices(self):
         for index in self.selected_indices:
             if index not in RasterIndexCalculator.indices_formulas:
-                logging.warning(f"Unsupported index: {index}")
+                log.warning("Unsupported index: %s", index)
                 raise ValueError(f"Unsupported index: {index}")
 
+    def __resolve_backend(self):
+        if self.backend == "auto":
+            self.backend = "gdal" if GDAL_BAND_ALGEBRA_AVAILABLE else "numpy"
+        elif self.backend not in ("qgis", "gdal", "numpy"):
+            log.warning("Unsupported backend: %s", self.backend)
+            raise ValueError(f"Unsupported backend: {self.backend}")
+        elif self.backend == "gdal" and not GDAL_BAND_ALGEBRA_AVAILABLE:
+            log.warning("GDAL %s does not support band algebra, GDAL 3.12 or newer is required", gdal.__version__)
+            raise ValueError(f"GDAL {gdal.__version__} does not support band algebra, GDAL 3.12 or newer is required")
+        log.debug("Using %s backend", self.backend)
+
+        if self.quantize_outputs and self.backend != "numpy":
+            log.warning("Quantized outputs are only supported by the numpy backend, %s backend writes Float32 outputs", self.backend)
+
+        if self.cog_output and self.backend != "qgis":
+            log.warning("COG outputs are only supported by the qgis backend, %s backend writes tiled GeoTIFF outputs", self.backend)
+
     @staticmethod
-    def create_tasks(input_files:list[str], output_dir:str, band_mapping:dict[str,int], raster_layers: list[QgsRasterLayer], selected_indices: list[str]):
+    def create_tasks(input_files:list[str], output_dir:str, band_mapping:dict[str,int], raster_layers: list[QgsRasterLayer], selected_indices: list[str], band_stats_cache: dict[tuple[str, int], QgsRasterBandStats]=None, approximate_statistics:bool=False, backend:str="qgis", quantize_outputs:bool=False, completion_event: threading.Event=None, cog_output:bool=False):
+        if band_stats_cache is None:
+            band_stats_cache = {}
+
         for input_file in input_files:
             input_file_name = os.path.split(os.path.splitext(input_file)[0])[-1]
+            # Opened once per input file and shared by all of its tasks
             raster_layer = RasterIndexCalculator.load_raster_layer(input_file)
             raster_memory_usage = RasterIndexCalculator.__calculate_raster_memory_usage(raster_layer)
             total_memory_usage = raster_memory_usage + raster_memory_usage / raster_layer.dataProvider().bandCount() # Input raster + calculated output raster
 
+            # Statistics of every band used by the selected indices, gathered once per band for all of them
+            band_stats = RasterIndexCalculator.get_raster_band_stats(raster_layer, [RasterIndexCalculator.indices_formulas_flat[index] for index in selected_indices], band_mapping, band_stats_cache, approximate_statistics)
+
+            if backend == "numpy":
+                # All indices of the input are calculated in one pass, reading every window of the input once
+                formulas = [RasterIndexCalculator.calculate_special_functions(raster_layer, RasterIndexCalculator.indices_formulas_flat[index], band_mapping, band_stats=band_stats) for index in selected_indices]
+                output_files = [os.path.join(output_dir, f"{input_file_name}_{index}.tiff") for index in selected_indices]
+                quantizations = [RasterIndexCalculator.indices_quantization.get(index) if quantize_outputs else None for index in selected_indices]
+
+                if log.isEnabledFor(logging.DEBUG):
+                    log.debug("Creating task for indices: %s, input file: %s", ", ".join(selected_indices), input_file)
+                yield RasterMultiIndexTask(
+                    f"Calculate {', '.join(selected_indices)} for {input_file_name}",
+                    raster_layer,
+                    total_memory_usage,
+                    selected_indices,
+                    formulas,
+                    band_mapping,
+                    output_files,
+                    quantizations,
+                    completion_event,
+                )
+                continue
+
             for index in selected_indices:
-                formula = RasterIndexCalculator.calculate_special_functions(raster_layer, RasterIndexCalculator.indices_formulas[index], band_mapping)
+                formula = RasterIndexCalculator.calculate_special_functions(raster_layer, RasterIndexCalculator.indices_formulas_flat[index], band_mapping, band_stats=band_stats)
 
-                output_in_memory_file = f"/vsimem/{input_file_name}_{index}.tiff"
                 output_file = os.path.join(output_dir, f"{input_file_name}_{index}.tiff")
+                # QgsRasterCalculator writes plain GeoTIFFs, the output only goes through memory when it has to be converted to COG afterwards
+                output_in_memory_file = f"/vsimem/calculated/{input_file_name}_{index}.tiff" if cog_output and backend == "qgis" else None
 
-                logging.debug(f"Creating task for index: {index}, output file: {output_file}")
+                log.debug("Creating task for index: %s, output file: %s", index, output_file)
                 task = RasterIndexCalculatorTask(
                     f"Calculate {index}",
-                    raster_layer.clone(),
+                    raster_layer,
                     total_memory_usage,
                     index,
                     formula,
                     band_mapping,
                     output_in_memory_file,
                     output_file,
+                    backend,
+                    completion_event=completion_event,
                 )
                 yield task
     
     @staticmethod
-    def calculate_special_functions(raster:QgsRasterLayer, index:str, band_mapping:dict[str,int]):
-        built_index = index
-
-        special_functions = RasterIndexCalculator.extract_special_functions(index)
-
-        while len(special_functions) > 0:
-
-            for func in special_functions:
-                full_match = func["whole_match"]
-                func_name = func["function_name"]
-                params = func["parameters"]
-
-                if func_name == "band_max":
-                    max_val = raster.dataProvider().bandStatistics(band_mapping[params[0]]).maximumValue
-                    built_index = built_index.replace(full_match, str(max_val))
-                elif func_name == "band_min":
-                    min_val = raster.dataProvider().bandStatistics(band_mapping[params[0]]).minimumValue
-                    built_index = built_index.replace(full_match, str(min_val))
-                elif func_name == "band_mean":
-                    mean_val = raster.dataProvider().bandStatistics(band_mapping[params[0]]).mean
-                    built_index = built_index.replace(full_match, str(mean_val))
-                elif func_name == "band_stddev":
-                    stddev_val = raster.dataProvider().bandStatistics(band_mapping[params[0]]).stdDev
-                    built_index = built_index.replace(full_match, str(stddev_val))
-                elif func_name == "index":
-                    index_val = RasterIndexCalculator.indices_formulas[params[0]]
-                    built_index = built_index.replace(full_match, f"({index_val})")
-            
-            special_functions = RasterIndexCalculator.extract_special_functions(built_index)
-            
-        logging.debug(f"Input index: {index}; Built index: {built_index}")
+    def calculate_special_functions(raster:QgsRasterLayer, index:str, band_mapping:dict[str,int], band_stats_cache: dict[tuple[str, int], QgsRasterBandStats]=None, approximate_statistics:bool=False, band_stats: dict[int, QgsRasterBandStats]=None):
+        if band_stats is None:
+            band_stats = RasterIndexCalculator.get_raster_band_stats(raster, [index], band_mapping, band_stats_cache, approximate_statistics)
+
+        band_values = {}
+        for func_name, band_name in RasterIndexCalculator.extract_band_functions(index):
+            stats = band_stats[band_mapping[band_name]]
+            if func_name == "band_max":
+                band_values[(func_name, band_name)] = stats.maximumValue
+            elif func_name == "band_min":
+                band_values[(func_name, band_name)] = stats.minimumValue
+            elif func_name == "band_mean":
+                band_values[(func_name, band_name)] = stats.mean
+            elif func_name == "band_stddev":
+                band_values[(func_name, band_name)] = stats.stdDev
+
+        # Rasters with the same statistics (e.g. captured by the same sensor) share the resolved formula
+        built_index = RasterIndexCalculator.resolve_formula(index, tuple(band_values.items()))
+
+        log.debug("Input index: %s; Built index: %s", index, built_index)
         return built_index
 
     @staticmethod
-    def extract_special_functions(expression):
+    @functools.lru_cache(maxsize=None)
+    def extract_band_functions(formula: str) -> tuple[tuple[str, str], ...]:
+        """
+        Returns the (function name, band name) pairs of the func_band_* functions used by a formula,
+        including those of the indices it references through func_index.
+        """
+        collector = _BandFunctionCollector()
+        collector.visit(_IndexFunctionInliner(RasterIndexCalculator.parsed_formulas).visit(parse_formula(formula)))
+        return tuple(collector.band_functions)
+
+    @staticmethod
+    @functools.lru_cache(maxsize=None)
+    def resolve_formula(formula: str, band_values: tuple[tuple[tuple[str, str], float], ...]) -> str:
         """
-        Extracts function names, their parameters, and the whole match from a string.
+        Resolves the special functions of a formula and returns it in raster calculator syntax.
+        The result only depends on the formula and the values of its func_band_* functions, so it is
+        cached on both and reused for every raster with the same statistics.
 
         Args:
-            expression (str): The input string containing functions.
+            formula (str): The formula to resolve.
+            band_values (tuple): ((function name, band name), value) pairs for the func_band_* functions of the formula.
 
         Returns:
-            list: A list of dictionaries, each containing the function name, parameters, and the whole match.
+            str: The resolved formula.
         """
-        # Regular expression to match functions in the format func_<name>(<parameters>)
-        pattern = r"(func_(\w+)\(([^)]*)\))"
-        matches = re.findall(pattern, expression)
-        
-        functions = []
-        for full_match, func_name, params in matches:
-            param_list = [param.strip() for param in params.split(",") if param.strip()]  # Split and clean parameters
-            functions.append({
-                "whole_match": full_match,
-                "function_name": func_name,
-                "parameters": param_list
-            })
-        
-        return functions
-        
+        tree = _IndexFunctionInliner(RasterIndexCalculator.parsed_formulas).visit(parse_formula(formula))
+        tree = _SpecialFunctionTransformer(dict(band_values)).visit(tree)
+        tree = _NormalizedRatioFolder().visit(tree)
+        return unparse_formula(tree)
+
+    @staticmethod
+    def get_raster_band_stats(raster: QgsRasterLayer, formulas: list[str], band_mapping: dict[str, int], band_stats_cache: dict[tuple[str, int], QgsRasterBandStats]=None, approximate_statistics: bool=False) -> dict[int, QgsRasterBandStats]:
+        """
+        Returns the statistics of every band used by the func_band_* functions of the formulas.
+        Each band is looked up once for all formulas, and the input dataset is opened at most once
+        for all bands missing from the cache, writing their statistics to the PAM sidecar at once.
+
+        Args:
+            raster (QgsRasterLayer): The raster layer.
+            formulas (list[str]): The formulas to be resolved on the raster.
+            band_mapping (dict): Mapping of band names to band numbers.
+            band_stats_cache (dict): Cache of band statistics keyed by (raster source, band number).
+            approximate_statistics (bool): Allow statistics computed from overviews or a subset of the pixels.
+
+        Returns:
+            dict[int, QgsRasterBandStats]: Statistics keyed by band number.
+        """
+        if band_stats_cache is None:
+            band_stats_cache = {}
+
+        band_indices = {band_mapping[band_name] for formula in formulas for _, band_name in RasterIndexCalculator.extract_band_functions(formula)}
+        missing_band_indices = [band_index for band_index in band_indices if (raster.source(), band_index) not in band_stats_cache]
+        if missing_band_indices:
+            dataset = gdal.Open(raster.source())
+            for band_index in missing_band_indices:
+                RasterIndexCalculator.get_band_stats(raster, dataset, band_index, band_stats_cache, approximate_statistics)
+            dataset.FlushCache()  # Writes the .aux.xml sidecar
+            dataset = None
+
+        return {band_index: band_stats_cache[(raster.source(), band_index)] for band_index in band_indices}
+
+    @staticmethod
+    def get_band_stats(raster: QgsRasterLayer, dataset: gdal.Dataset, band_index: int, band_stats_cache: dict[tuple[str, int], QgsRasterBandStats], approximate: bool=False) -> QgsRasterBandStats:
+        """
+        Returns the statistics of a raster band, computing them only on the first request.
+        Statistics are read from the GDAL PAM (.aux.xml) sidecar when available, otherwise they
+        are computed and set on the band, to be persisted when the caller flushes the dataset,
+        so following runs over the same input skip the raster scan.
+
+        Args:
+            raster (QgsRasterLayer): The raster layer.
+            dataset (gdal.Dataset): The dataset of the raster layer, opened by the caller.
+            band_index (int): The band number.
+            band_stats_cache (dict): Cache of band statistics keyed by (raster source, band number).
+            approximate (bool): Allow statistics computed from overviews or a subset of the pixels.
+
+        Returns:
+            QgsRasterBandStats: Minimum, maximum, mean and standard deviation of the band.
+        """
+        key = (raster.source(), band_index)
+        cached_stats = band_stats_cache.get(key)
+        if cached_stats is not None:
+            return cached_stats
+
+        band = dataset.GetRasterBand(band_index)
+        try:
+            values = band.GetStatistics(approximate, False)
+        except RuntimeError:
+            values = None
+
+        stats = QgsRasterBandStats()
+        stats.bandNumber = band_index
+
+        # GDAL reports missing statistics either as None or with a negative standard deviation
+        if values is None or values[3] < 0:
+            log.debug("Computing statistics for band %s of %s", band_index, raster.name())
+            values = band.ComputeStatistics(approximate)
+            band.SetStatistics(*values)
+        stats.minimumValue, stats.maximumValue, stats.mean, stats.stdDev = values
+        stats.statsGathered = QgsRasterBandStats.Min | QgsRasterBandStats.Max | QgsRasterBandStats.Range | QgsRasterBandStats.Mean | QgsRasterBandStats.StdDev
+        stats.range = stats.maximumValue - stats.minimumValue
+
+        band_stats_cache[key] = stats
+        return stats
 
     def execute(self):
         self.__validate_indices()
+        self.__resolve_backend()
 
         start_time = time.time()
 
-        task_generator = RasterIndexCalculator.create_tasks(self.input_files, self.output_dir, self.band_mapping, self.raster_layers, self.selected_indices)
+        task_generator = RasterIndexCalculator.create_tasks(self.input_files, self.output_dir, self.band_mapping, self.raster_layers, self.selected_indices, self._band_stats_cache, self.approximate_statistics, self.backend, self.quantize_outputs, self._completion_event, self.cog_output)
 
-        QgsApplication.taskManager().addTask(self.raster_save_task)
+        # Only the qgis backend converting its outputs to COG needs rasters to be saved afterwards
+        uses_save_task = self.backend == "qgis" and self.cog_output
+        if uses_save_task:
+            QgsApplication.taskManager().addTask(self.raster_save_task)
 
         # Start tasks
         for task in task_generator:
             if task.total_memory_usage > self.max_memory_usage:
-                logging.warning(f"Task {task.description()} with {task.total_memory_usage} MB exceeds the maximum memory usage, skipping.")
-                self.results.append({"index": task.index, "calculation_status": "error", "message": f"Task {task.description()} exceeds the maximum memory usage", "output_file": None, "time_spent": 0, "saving_status": None})
+                log.warning("Task %s with %s MB exceeds the maximum memory usage, skipping.", task.description(), task.total_memory_usage)
+                for index in (task.indices if isinstance(task, RasterMultiIndexTask) else [task.index]):
+                    self.results.append({"index": index, "calculation_status": "error", "message": f"Task {task.description()} exceeds the maximum memory usage", "output_file": None, "time_spent": 0, "saving_status": None})
                 continue
 
             self.memory_usage += task.total_memory_usage
             self.active_tasks.append(task)
             QgsApplication.taskManager().addTask(task)
-            logging.debug("Adding a task")
+            log.debug("Adding a task")
             
-            logging.debug(f"Memory usage: {self.memory_usage}")
+            log.debug("Memory usage: %s", self.memory_usage)
 
             
             self.__transfer_finished_tasks_to_saving_queue()
             self.__save_rasters_from_memory_to_disk()
             self.__get_saved_rasters()
 
-            # Wait for some tasks to finish or until the maximum number of concurrent tasks is reached
-            if (self.memory_usage >= self.max_memory_usage or len(self.active_tasks) >= self.max_active_tasks):
-                while (self.memory_usage >= self.max_memory_usage and len(self.active_tasks) >= self.max_active_tasks) and all(t.progress() != 100 for t in self.active_tasks):
-                    logging.debug(f"Waiting {0.50:.2f}s, active tasks: {len(self.active_tasks)}")
-                    time.sleep(0.50)
-            
-            
-            # if len(self.saving_tasks_queue) > 0:
-            #     self.save_raster_from_memory_to_disk(self.saving_tasks_queue.pop())
+            # Wait for some tasks to finish while the maximum memory usage or number of concurrent tasks is reached
+            while self.memory_usage >= self.max_memory_usage or len(self.active_tasks) >= self.max_active_tasks:
+                self.__wait_for_completion()
+                self.__transfer_finished_tasks_to_saving_queue()
+                self.__save_rasters_from_memory_to_disk()
+                self.__get_saved_rasters()
 
         # Wait for all tasks to finish
         while len(self.active_tasks) > 0:
-            logging.debug(f"Waiting {0.50:.2f}s, active tasks: {len(self.active_tasks)}, memory usage: {self.memory_usage}")
-            time.sleep(0.50)
+            self.__wait_for_completion()
             self.__transfer_finished_tasks_to_saving_queue()
             self.__save_rasters_from_memory_to_disk()
             self.__get_saved_rasters()
 
-            # for task in self.saving_tasks_queue:
-            #     self.save_raster_from_memory_to_disk(task)
-            #     self.saving_tasks_queue.remove(task)
-
         while len(self.results) < self.number_of_tasks:
-            logging.debug(f"Waiting {0.50:.2f}s, active saving: {len(self.active_tasks) - len(self.results)}, memory usage: {self.memory_usage}")
-            time.sleep(0.50)
+            self.__wait_for_completion()
             self.__get_saved_rasters()
 
+        if uses_save_task:
+            self.raster_save_task.cancel()  # Every raster has been saved, stops the worker
 
         self.total_time = time.time() - start_time
 
@@ -231,6 +405,16 @@ class RasterIndexCalculator:
             "total_time": self.total_time
         }
     
+    def __wait_for_completion(self, timeout: float=5.0):
+        """
+        Blocks until a task finishes its calculation or a raster is saved, or until the timeout expires.
+        Tasks set the event only after publishing their result, so clearing it right after waking up
+        cannot lose a completion: it is picked up by the checks that follow the wait.
+        """
+        log.debug("Waiting for a task to finish, active tasks: %s, memory usage: %s", len(self.active_tasks), self.memory_usage)
+        self._completion_event.wait(timeout)
+        self._completion_event.clear()
+
     def __get_saved_rasters(self):
         # Get saved rasters from the RasterSaveTask
         for saved_raster in self.raster_save_task.get_and_reset_saved_rasters():
@@ -253,7 +437,7 @@ class RasterIndexCalculator:
     
     def __set_progress(self, progress):
         self.progress = progress
-        logging.info(f"Progress: {self.progress}%")
+        log.info("Progress: %s%%", self.progress)
 
     def __transfer_finished_tasks_to_saving_queue(self):
         """
@@ -261,13 +445,16 @@ class RasterIndexCalculator:
         This method iterates through the list of active tasks and checks their progress. If a task's progress
         is 100%, it is considered finished. Depending on the task's calculation status, it is either moved
         to the saving queue or handled as a failed task.
-        - If the task's calculation status is "success", it is added to the saving tasks queue.
+        - If the task's calculation status is "success", it is added to the saving tasks queue,
+          unless the task already wrote its output to disk, in which case it is handled as completed.
+        - Tasks calculating several indices at once always write their outputs to disk, the result
+          of each index is appended to the results list.
         - If the task's calculation status is not "success", it is treated as a failed task:
             - A warning is logged.
             - The memory usage is reduced by the task's total memory usage.
             - The task's result is appended to the results list.
             - The progress is increased.
-        The task is then removed from the active tasks list.
+        Finished tasks are then removed from the active tasks list, which is rebuilt in the same pass.
         Logging:
             - Logs a debug message when a task is moved to the saving queue.
             - Logs a warning message when a task fails.
@@ -277,30 +464,158 @@ class RasterIndexCalculator:
         Note:
             Ensure thread safety if this method is called in a multi-threaded environment.
         """
+        still_active_tasks = []
         for task in self.active_tasks:
-            if task.progress() == 100:
-                if task.result["calculation_status"] == "success":
-                    logging.debug(f"Moving task from active to saving queue: {task.description()}")
-                    self.saving_tasks_queue.append(task)
-                else:
-                    logging.warning(f"Task {task.description()} failed, skipping saving to disk.")
-                    self.memory_usage -= task.total_memory_usage
-                    self.results.append(task.result)
+            if task.progress() != 100:
+                still_active_tasks.append(task)
+                continue
+
+            if isinstance(task, RasterMultiIndexTask):
+                log.debug("Task %s finished calculating %s indices", task.description(), len(task.results))
+                self.memory_usage -= task.total_memory_usage
+                for result in task.results:
+                    self.results.append(result)
                     self.__increase_progress()
-                    
-                self.active_tasks.remove(task)
+            elif task.result["calculation_status"] == "success" and task.result["saving_status"] == "success":
+                log.debug("Task %s already saved its output: %s", task.description(), task.output_file)
+                self.memory_usage -= task.total_memory_usage
+                self.results.append(task.result)
+                self.__increase_progress()
+            elif task.result["calculation_status"] == "success":
+                log.debug("Moving task from active to saving queue: %s", task.description())
+                self.saving_tasks_queue.append(task)
+            else:
+                log.warning("Task %s failed, skipping saving to disk.", task.description())
+                self.memory_usage -= task.total_memory_usage
+                self.results.append(task.result)
+                self.__increase_progress()
+
+        self.active_tasks = still_active_tasks
 
     @staticmethod
     def __calculate_raster_memory_usage(raster: QgsRasterLayer):
+        data_provider = raster.dataProvider()
+
         # Get raster dimensions
-        width = raster.dataProvider().ySize()  # Number of columns
-        height = raster.dataProvider().xSize()  # Number of rows
-        bands = raster.dataProvider().bandCount()  # Number of bands
-        
-        # Get the data type of the raster (e.g., Byte, Float32)
-        bytes_per_pixel = raster.dataProvider().dataTypeSize(1) # 8  # Convert bits to bytes
-        
+        width = data_provider.xSize()  # Number of columns
+        height = data_provider.ySize()  # Number of rows
+        bands = data_provider.bandCount()  # Number of bands
+
+        # Get the data type of the raster (e.g., Byte, Float32), dataTypeSize returns the size in bytes
+        bytes_per_pixel = data_provider.dataTypeSize(1)
+
         # Calculate memory usage
         memory_usage = width * height * bands * bytes_per_pixel
-        logging.debug(f"Raster dimensions for {raster.name()}: {width}x{height}x{bands}; Bytes per pixel: {bytes_per_pixel}; Memory usage: {memory_usage / 1024 / 1024} MB")
-        return memory_usage / 1024 / 1024  # Convert bytes to megabytes
\ No newline at end of file
+        if log.isEnabledFor(logging.DEBUG):
+            log.debug("Raster dimensions for %s: %sx%sx%s; Bytes per pixel: %s; Memory usage: %s MB", raster.name(), width, height, bands, bytes_per_pixel, memory_usage / 1024 / 1024)
+        return memory_usage / 1024 / 1024  # Convert bytes to megabytes
+
+
+class _BandFunctionCollector(ast.NodeVisitor):
+    """
+    Collects the (function name, band name) pairs of func_band_* functions.
+    func_index references must be inlined beforehand.
+    """
+    def __init__(self):
+        self.band_functions = []
+
+    def visit_Call(self, node: ast.Call):
+        if not isinstance(node.func, ast.Name) or not node.func.id.startswith("func_"):
+            self.generic_visit(node)
+            return
+
+        func_name = node.func.id[len("func_"):]
+        params = [ast.unparse(arg) for arg in node.args]
+
+        if func_name not in ("band_max", "band_min", "band_mean", "band_stddev"):
+            raise ValueError(f"Unsupported special function: {node.func.id}")
+        if (func_name, params[0]) not in self.band_functions:
+            self.band_functions.append((func_name, params[0]))
+
+
+def _constant_node(value: float) -> ast.expr:
+    """
+    Returns the AST of a numeric constant. Negative values are wrapped in a unary minus, as the parser
+    builds them, so that they are unparsed with explicit parentheses where needed, e.g. (-5.0) ^ 2.
+    """
+    if value < 0:
+        return ast.UnaryOp(ast.USub(), ast.Constant(-value))
+    return ast.Constant(value)
+
+
+def _constant_value(node: ast.expr):
+    """
+    Returns the value of a numeric constant built by _constant_node, or None for any other node.
+    """
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub):
+        value = _constant_value(node.operand)
+        return -value if value is not None else None
+    if isinstance(node, ast.Constant) and isinstance(node.value, (int, float)) and not isinstance(node.value, bool):
+        return node.value
+    return None
+
+
+class _SpecialFunctionTransformer(ast.NodeTransformer):
+    """
+    Replaces func_band_max/min/mean/stddev(<band>) with constants from the given band values.
+    func_index references must be inlined beforehand.
+    """
+    def __init__(self, band_values: dict[tuple[str, str], float]):
+        self.band_values = band_values
+
+    def visit_Call(self, node: ast.Call):
+        if not isinstance(node.func, ast.Name) or not node.func.id.startswith("func_"):
+            return self.generic_visit(node)
+
+        func_name = node.func.id[len("func_"):]
+        params = [ast.unparse(arg) for arg in node.args]
+        return _constant_node(self.band_values[(func_name, params[0])])
+
+
+class _NormalizedRatioFolder(ast.NodeTransformer):
+    """
+    Folds ratios of normalized bands into a single division, e.g.
+    (R / maxR) / (R / maxR + G / maxG + B / maxB) -> R / (R + G * (maxR / maxG) + B * (maxR / maxB)).
+    The normalization constants cancel out entirely when the maxima are equal.
+    Must run after the special functions have been resolved to constants.
+    """
+    def visit_BinOp(self, node: ast.BinOp):
+        self.generic_visit(node)
+        if not isinstance(node.op, ast.Div):
+            return node
+
+        numerator = _NormalizedRatioFolder.__as_normalized_band(node.left)
+        terms = _NormalizedRatioFolder.__sum_terms(node.right)
+        normalized_terms = [_NormalizedRatioFolder.__as_normalized_band(term) for term in terms]
+        if numerator is None or None in normalized_terms or numerator not in normalized_terms:
+            return node
+
+        band, scale = numerator
+        if scale == 0 or any(term_scale == 0 for _, term_scale in normalized_terms):
+            return node
+
+        folded_terms = []
+        for term_band, term_scale in normalized_terms:
+            factor = scale / term_scale
+            term = ast.Name(term_band, ast.Load())
+            folded_terms.append(term if factor == 1 else ast.BinOp(term, ast.Mult(), _constant_node(factor)))
+
+        denominator = folded_terms[0]
+        for term in folded_terms[1:]:
+            denominator = ast.BinOp(denominator, ast.Add(), term)
+        return ast.BinOp(ast.Name(band, ast.Load()), ast.Div(), denominator)
+
+    @staticmethod
+    def __as_normalized_band(node: ast.expr):
+        # Matches <band> / <constant> and returns (band, constant)
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Div) and isinstance(node.left, ast.Name):
+            value = _constant_value(node.right)
+            if value is not None:
+                return node.left.id, value
+        return None
+
+    @staticmethod
+    def __sum_terms(node: ast.expr):
+        if isinstance(node, ast.BinOp) and isinstance(node.op, ast.Add):
+            return _NormalizedRatioFolder.__sum_terms(node.left) + _NormalizedRatioFolder.__sum_terms(node.right)
+        return [node]
@@ -1,73 +1,313 @@
 from qgis.analysis import QgsRasterCalculator, QgsRasterCalculatorEntry
 from qgis.core import QgsApplication, QgsTask, QgsMessageLog, Qgis, QgsRasterLayer, QgsRasterBandStats
-import time, logging, os
+from RasterFormulaParser import parse_formula
+from osgeo import gdal
+import numpy as np
+import time, logging, os, ast, threading, re, functools
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+log = logging.getLogger(__name__)
+
+# Band arithmetic on gdal.Band objects (evaluated lazily block by block) is available since GDAL 3.12
+GDAL_BAND_ALGEBRA_AVAILABLE = int(gdal.VersionInfo()) >= 3120000
+
+# Same no data value as QgsRasterCalculator uses for Float32 outputs
+FLOAT32_NO_DATA = float(np.finfo(np.float32).min)
+
+# Outputs are compressed with DEFLATE using all CPUs, PREDICTOR=YES picks the predictor matching the data type
+COG_CREATION_OPTIONS = ["COMPRESS=DEFLATE", "PREDICTOR=YES", "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"]
+# Outputs computed on the fly are written as a tiled GeoTIFF, in a single pass over the input
+GTIFF_CREATION_OPTIONS = ["TILED=YES", "COMPRESS=DEFLATE", "NUM_THREADS=ALL_CPUS", "BIGTIFF=IF_SAFER"]
+
+# Integer output types of quantized indices: (NumPy type, lowest value, highest value, no data value)
+QUANTIZED_TYPES = {
+    gdal.GDT_Int16: (np.int16, -32767, 32767, -32768),
+    gdal.GDT_Byte: (np.uint8, 0, 254, 255),
+}
+
+# Minimum size of the windows read at once by the numpy backend, rounded up to whole raster blocks
+NUMPY_WINDOW_SIZE = 512
+
+@functools.lru_cache(maxsize=None)
+def band_token_pattern(band_names: tuple[str, ...]) -> re.Pattern:
+    """
+    Returns a compiled pattern matching whole band names, longest names first.
+    """
+    return re.compile(r"\b(" + "|".join(map(re.escape, sorted(band_names, key=len, reverse=True))) + r")\b")
+
+
+# Numba kernels keyed by (formula without its constants, band names), shared by all tasks
+_KERNEL_CACHE = {}
+_KERNEL_CACHE_LOCK = threading.Lock()
+
+
+def get_numba_kernel(formula: str, band_names: tuple[str, ...]):
+    """
+    Returns a Numba compiled kernel evaluating the formula pixel by pixel in a single pass,
+    without the intermediate arrays NumPy allocates for every subexpression, or None when Numba is not installed.
+    The kernel is called as kernel(*band_arrays, out) with flat Float32 arrays.
+    Float constants, which include the band statistics resolved per raster, are passed to the compiled
+    kernel as an array, so formulas differing only by their constants share one compiled kernel.
+    """
+    if numba is None:
+        return None
+
+    constants = _ConstantParameterTransformer()
+    tree = _PixelAccessTransformer(band_names).visit(constants.visit(parse_formula(formula)))
+    expression = ast.unparse(tree)
+
+    key = (expression, band_names)
+    with _KERNEL_CACHE_LOCK:
+        if key not in _KERNEL_CACHE:
+            source = (
+                f"def kernel({', '.join(('_c',) + band_names + ('_out',))}):\n"
+                f"    for _i in range(_out.size):\n"
+                f"        _out[_i] = {expression}\n"
+            )
+            namespace = {}
+            exec(source, namespace)
+            # Division by zero yields inf/nan like NumPy, which must stay detectable, so nnan/ninf are not assumed
+            _KERNEL_CACHE[key] = numba.njit(fastmath={"nsz", "arcp", "contract", "afn", "reassoc"}, error_model="numpy")(namespace["kernel"])
+        kernel = _KERNEL_CACHE[key]
+    return functools.partial(kernel, np.array(constants.values, dtype=np.float64))
+
+
+class _ConstantParameterTransformer(ast.NodeTransformer):
+    """
+    Replaces float constants with reads from the constants array _c, collecting their values.
+    Integer constants, such as the exponents of powers, are kept as literals.
+    """
+    def __init__(self):
+        self.values = []
+
+    def visit_Constant(self, node: ast.Constant):
+        if isinstance(node.value, float):
+            self.values.append(node.value)
+            return ast.Subscript(ast.Name("_c", ast.Load()), ast.Constant(len(self.values) - 1), ast.Load())
+        return node
+
+
+class _PixelAccessTransformer(ast.NodeTransformer):
+    """
+    Replaces band references with the access to the current pixel of the band array.
+    """
+    def __init__(self, band_names: tuple[str, ...]):
+        self.band_names = band_names
+
+    def visit_Name(self, node: ast.Name):
+        if node.id in self.band_names:
+            return ast.Subscript(ast.Name(node.id, ast.Load()), ast.Name("_i", ast.Load()), ast.Load())
+        return node
+
 
 class RasterIndexCalculatorTask(QgsTask):
-    def __init__(self, description: str, raster_layer: QgsRasterLayer, total_memory_usage:int, index, formula: str, band_mapping: dict[str, int], output_in_memory_file:str, output_file: str):
+    def __init__(self, description: str, raster_layer: QgsRasterLayer, total_memory_usage:int, index, formula: str, band_mapping: dict[str, int], output_in_memory_file:str, output_file: str, backend: str="qgis", completion_event: threading.Event=None):
         super().__init__(description, QgsTask.CanCancel)
         self.raster_layer = raster_layer
         self.index = index
         self.formula = formula
         self.band_mapping = band_mapping
         self.output_in_memory_file = output_in_memory_file
-        self.task_output_file = self.output_in_memory_file if self.output_in_memory_file else self.output_file
         self.output_file = output_file
+        self.task_output_file = self.output_in_memory_file if self.output_in_memory_file else self.output_file
         self.result = None
         self.total_memory_usage = total_memory_usage
+        self.backend = backend
+        self.completion_event = completion_event
+        # The resolved formula is compiled once, bands are bound by name when it is evaluated
+        self.compiled_formula = compile(parse_formula(self.formula), f"<{self.index}>", "eval")
 
     def run(self):
+        start_time = time.time()
         try:
-            logging.debug(f"Starting calculation for index: {self.index}")
-            entries = []
-            for band_name, band_index in self.band_mapping.items():
-                entry = QgsRasterCalculatorEntry()
-                entry.ref = f'{band_name}@{band_index}'
-                entry.raster = self.raster_layer
-                entry.bandNumber = band_index
-                entries.append(entry)
-
-            formula_with_bands = self.formula
-            for band_name, band_index in self.band_mapping.items():
-                formula_with_bands = formula_with_bands.replace(band_name, f'"{band_name}@{band_index}"')
-
-            logging.debug(f"Formula for {self.index}: {formula_with_bands}")
-            start_time = time.time()
-
-            calc = QgsRasterCalculator(
-                formula_with_bands,
-                self.output_in_memory_file,
-                "GTiff",
-                self.raster_layer.extent(),
-                self.raster_layer.width(),
-                self.raster_layer.height(),
-                entries
-            )
-
-            result = calc.processCalculation()
+            log.debug("Starting calculation for index: %s using %s backend", self.index, self.backend)
+            if self.backend == "gdal":
+                error = self.__calculate_with_gdal_band_algebra()
+            else:
+                error = self.__calculate_with_qgis_raster_calculator()
             time_spent = time.time() - start_time
 
             self.raster_layer = None
 
-            if result != QgsRasterCalculator.Success:
-                self.result = {"index": self.index, "calculation_status": "error", "message": calc.lastError(), "output_file": None, "time_spent": time_spent, "saving_status": None}
-                logging.warning(f"Failed to calculate index: {self.index}")
+            if error is not None:
+                self.result = {"index": self.index, "calculation_status": "error", "message": error, "output_file": None, "time_spent": time_spent, "saving_status": None}
+                log.warning("Failed to calculate index: %s", self.index)
+            elif self.backend == "gdal" or self.task_output_file == self.output_file:
+                # The output was streamed straight to its final location, there is nothing left to save
+                self.result = {"index": self.index, "calculation_status": "success", "message": None, "output_file": self.output_file, "time_spent": time_spent, "saving_status": "success"}
+                log.info("Successfully calculated index: %s in %.2f seconds", self.index, time_spent)
             else:
                 self.result = {"index": self.index, "calculation_status": "success", "message": None, "output_file": None, "time_spent": time_spent, "saving_status": None}
-                logging.info(f"Successfully calculated index: {self.index} in {time_spent:.2f} seconds")
+                log.info("Successfully calculated index: %s in %.2f seconds", self.index, time_spent)
         except Exception as e:
             time_spent = time.time() - start_time
             self.result = {"index": self.index, "calculation_status": "exception", "message": str(e), "output_file": None, "time_spent": time_spent, "saving_status": None}
-            logging.critical(f"Error calculating index {self.index}: {e}")
+            log.critical("Error calculating index %s: %s", self.index, e)
         finally:
             self.setProgress(100)
+            if self.completion_event is not None:
+                self.completion_event.set()
             return self.result["calculation_status"] == "success"
 
+    def __calculate_with_qgis_raster_calculator(self):
+        """
+        Calculates the index with QgsRasterCalculator into the task output file: the in-memory file
+        when the output is converted by RasterSaveTask afterwards, otherwise the output file itself.
+        The input layer is the private layer shared by all tasks of the input file, whose provider
+        serializes concurrent block reads, so no layer is opened per task.
+        Returns None on success or the error message.
+        """
+        raster_layer = self.raster_layer
+
+        entries = []
+        for band_name, band_index in self.band_mapping.items():
+            entry = QgsRasterCalculatorEntry()
+            entry.ref = f'{band_name}@{band_index}'
+            entry.raster = raster_layer
+            entry.bandNumber = band_index
+            entries.append(entry)
+
+        # Rewrites band names to raster calculator references in a single pass, e.g. R -> "R@1"
+        formula_with_bands = band_token_pattern(tuple(self.band_mapping)).sub(lambda match: f'"{match.group(1)}@{self.band_mapping[match.group(1)]}"', self.formula)
+
+        log.debug("Formula for %s: %s", self.index, formula_with_bands)
+
+        calc = QgsRasterCalculator(
+            formula_with_bands,
+            self.task_output_file,
+            "GTiff",
+            raster_layer.extent(),
+            raster_layer.width(),
+            raster_layer.height(),
+            entries
+        )
+
+        if calc.processCalculation() != QgsRasterCalculator.Success:
+            return calc.lastError()
+        return None
+
+    def __calculate_with_gdal_band_algebra(self):
+        """
+        Calculates the index with GDAL band algebra. The formula is evaluated on gdal.Band objects,
+        which builds a lazily evaluated band that is computed block by block while being copied
+        directly to the output file, without an in-memory intermediate raster.
+        Pixels with no data in any input band, or with an undefined result (e.g. division by zero),
+        are set to no data as QgsRasterCalculator does.
+        Returns None on success or the error message.
+        """
+        with gdal.Open(self.raster_layer.source()) as dataset:
+            bands = {band_name: dataset.GetRasterBand(band_index) for band_name, band_index in self.band_mapping.items()}
+            computed_band = eval(self.compiled_formula, {"__builtins__": None}, bands)
+            if not isinstance(computed_band, gdal.Band):
+                return f"Formula of {self.index} does not reference any band: {self.formula}"
+
+            computed_band = computed_band.astype(gdal.GDT_Float32)
+            # Comparisons are false for NaN, so the two bounds also catch undefined results
+            computed_band = gdal.where(computed_band >= FLOAT32_NO_DATA, computed_band, FLOAT32_NO_DATA)
+            computed_band = gdal.where(computed_band <= -FLOAT32_NO_DATA, computed_band, FLOAT32_NO_DATA)
+            for band in bands.values():
+                no_data_value = band.GetNoDataValue()
+                if no_data_value is not None:
+                    computed_band = gdal.where(band == no_data_value, FLOAT32_NO_DATA, computed_band)
+            computed_band = computed_band.astype(gdal.GDT_Float32)
+            computed_band.SetNoDataValue(FLOAT32_NO_DATA)
+            # COG would build overviews first, evaluating the formula twice, so a tiled GeoTIFF is written in one pass
+            gdal.GetDriverByName("GTiff").CreateCopy(self.output_file, computed_band.GetDataset(), options=GTIFF_CREATION_OPTIONS + ["PREDICTOR=3"])
+        return None
+
+    @staticmethod
+    def create_output(dataset: gdal.Dataset, output_file: str, quantization: tuple[int, float, float]=None):
+        """
+        Creates a single band tiled and compressed GeoTIFF with the size and georeferencing of the input dataset.
+        The band is Float32, or the integer type of the quantization (data type, scale, offset), in which case
+        the band scale and offset are set so that GDAL based readers get the original values back.
+        Returns the output dataset and its band.
+        """
+        data_type = quantization[0] if quantization else gdal.GDT_Float32
+        predictor = "PREDICTOR=2" if quantization else "PREDICTOR=3"  # Horizontal differencing for integers, floating point predictor otherwise
+        output = gdal.GetDriverByName("GTiff").Create(output_file, dataset.RasterXSize, dataset.RasterYSize, 1, data_type, options=GTIFF_CREATION_OPTIONS + [predictor])
+        output.SetGeoTransform(dataset.GetGeoTransform())
+        output.SetProjection(dataset.GetProjection())
+        output_band = output.GetRasterBand(1)
+        if quantization:
+            _, scale, offset = quantization
+            output_band.SetNoDataValue(QUANTIZED_TYPES[data_type][3])
+            output_band.SetScale(1 / scale)
+            output_band.SetOffset(-offset / scale)
+        else:
+            output_band.SetNoDataValue(FLOAT32_NO_DATA)
+        return output, output_band
+
+    @staticmethod
+    def quantize_window(result: np.ndarray, quantization: tuple[int, float, float]=None) -> np.ndarray:
+        """
+        Converts an evaluated window to the integer type of the quantization (data type, scale, offset)
+        as round(value * scale + offset), clipped to the type range. Without a quantization the window is returned as is.
+        """
+        if not quantization:
+            return result
+
+        data_type, scale, offset = quantization
+        numpy_type, lowest, highest, no_data_value = QUANTIZED_TYPES[data_type]
+        # No data pixels (-FLT_MAX) overflow to -inf when scaled, they are replaced right after
+        with np.errstate(over="ignore"):
+            quantized = np.clip(np.rint(result * scale + offset), lowest, highest)
+        return np.where(result == np.float32(FLOAT32_NO_DATA), no_data_value, quantized).astype(numpy_type)
+
+    @staticmethod
+    def block_aligned_windows(dataset: gdal.Dataset, band: gdal.Band) -> list[tuple[int, int, int, int]]:
+        """
+        Splits the dataset into (xoff, yoff, xsize, ysize) windows of at least NUMPY_WINDOW_SIZE pixels
+        per side (unless the raster is smaller), made of whole blocks of the band.
+        """
+        width, height = dataset.RasterXSize, dataset.RasterYSize
+        block_width, block_height = band.GetBlockSize()
+        window_width = -(-NUMPY_WINDOW_SIZE // block_width) * block_width
+        window_height = -(-NUMPY_WINDOW_SIZE // block_height) * block_height
+        return [(x, y, min(window_width, width - x), min(window_height, height - y)) for y in range(0, height, window_height) for x in range(0, width, window_width)]
+
+    @staticmethod
+    def read_window(input_bands: dict[str, gdal.Band], window: tuple[int, int, int, int]):
+        """
+        Reads a window of every input band as a Float32 array.
+        Returns the arrays keyed by band name and the mask of pixels with no data in any band.
+        """
+        xoff, yoff, xsize, ysize = window
+        arrays = {}
+        no_data_mask = np.zeros((ysize, xsize), dtype=bool)
+        for band_name, band in input_bands.items():
+            arrays[band_name] = band.ReadAsArray(xoff, yoff, xsize, ysize, buf_type=gdal.GDT_Float32)
+            no_data_value = band.GetNoDataValue()
+            if no_data_value is not None:
+                no_data_mask |= arrays[band_name] == np.float32(no_data_value)
+        return arrays, no_data_mask
+
+    @staticmethod
+    def evaluate_window(compiled_formula, kernel, band_names: tuple[str, ...], arrays: dict[str, np.ndarray], no_data_mask: np.ndarray) -> np.ndarray:
+        """
+        Evaluates a formula on a window, with the Numba kernel when given, otherwise with NumPy.
+        Pixels in the no data mask or with a non finite result are set to no data.
+        """
+        if kernel is not None:
+            result = np.empty(no_data_mask.size, dtype=np.float32)
+            kernel(*(arrays[band_name].ravel() for band_name in band_names), result)
+            result = result.reshape(no_data_mask.shape)
+        else:
+            with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+                result = np.asarray(eval(compiled_formula, {"__builtins__": None}, arrays), dtype=np.float32)
+            result = np.broadcast_to(result, no_data_mask.shape)
+        return np.where(no_data_mask | ~np.isfinite(result), np.float32(FLOAT32_NO_DATA), result)
+
     def cancel(self):
-        logging.warning(f"Task {self.index} was canceled.")
+        log.warning("Task %s was canceled.", self.index)
         super().cancel()
 
     def finished(self, success):
         if success:
-            logging.info(f"{self.result}")
+            log.info("%s", self.result)
         else:
-            logging.warning(f"{self.result}")
+            log.warning("%s", self.result)
@@ -0,0 +1,96 @@
+from RasterIndexCalculatorTask import RasterIndexCalculatorTask, get_numba_kernel
+from RasterFormulaParser import parse_formula
+from qgis.core import QgsTask, QgsRasterLayer
+from osgeo import gdal
+import time, logging, threading
+
+log = logging.getLogger(__name__)
+
+
+class RasterMultiIndexTask(QgsTask):
+    """
+    Calculates several indices of one input raster with NumPy in a single pass over the input.
+    Every window of the input bands is read once and all indices are evaluated on it before moving
+    on to the next window, each index being written directly to its own output file.
+    """
+    def __init__(self, description: str, raster_layer: QgsRasterLayer, total_memory_usage:int, indices: list[str], formulas: list[str], band_mapping: dict[str, int], output_files: list[str], quantizations: list[tuple[int, float, float]]=None, completion_event: threading.Event=None):
+        super().__init__(description, QgsTask.CanCancel)
+        self.raster_layer = raster_layer
+        self.indices = indices
+        self.formulas = formulas
+        self.band_mapping = band_mapping
+        self.output_files = output_files
+        self.quantizations = quantizations if quantizations is not None else [None] * len(indices)
+        self.results = []
+        self.completion_event = completion_event
+        self.total_memory_usage = total_memory_usage
+        self.compiled_formulas = [compile(parse_formula(formula), f"<{index}>", "eval") for index, formula in zip(indices, formulas)]
+
+    def run(self):
+        start_time = time.time()
+        errors = {}
+        try:
+            if log.isEnabledFor(logging.DEBUG):
+                log.debug("Starting calculation for indices: %s", ", ".join(self.indices))
+            band_names = tuple(self.band_mapping)
+            kernels = [get_numba_kernel(formula, band_names) for formula in self.formulas]
+
+            with gdal.Open(self.raster_layer.source()) as dataset:
+                input_bands = {band_name: dataset.GetRasterBand(band_index) for band_name, band_index in self.band_mapping.items()}
+                outputs = [RasterIndexCalculatorTask.create_output(dataset, output_file, quantization) for output_file, quantization in zip(self.output_files, self.quantizations)]
+                windows = RasterIndexCalculatorTask.block_aligned_windows(dataset, next(iter(input_bands.values())))
+
+                for window_number, window in enumerate(windows):
+                    if self.isCanceled():
+                        for index in self.indices:
+                            errors.setdefault(index, f"Calculation of {index} was canceled")
+                        break
+
+                    arrays, no_data_mask = RasterIndexCalculatorTask.read_window(input_bands, window)
+                    for index, compiled_formula, kernel, quantization, (_, output_band) in zip(self.indices, self.compiled_formulas, kernels, self.quantizations, outputs):
+                        if index in errors:
+                            continue
+                        try:
+                            result = RasterIndexCalculatorTask.evaluate_window(compiled_formula, kernel, band_names, arrays, no_data_mask)
+                            output_band.WriteArray(RasterIndexCalculatorTask.quantize_window(result, quantization), window[0], window[1])
+                        except Exception as e:
+                            # A failing index does not stop the calculation of the others
+                            errors[index] = str(e)
+                            log.critical("Error calculating index %s: %s", index, e)
+
+                    self.setProgress(99 * (window_number + 1) / len(windows))  # 100 marks the task as finished
+
+                outputs = None
+            for index, output_file in zip(self.indices, self.output_files):
+                if index in errors:
+                    gdal.Unlink(output_file)
+            time_spent = time.time() - start_time
+
+            self.raster_layer = None
+
+            for index, output_file in zip(self.indices, self.output_files):
+                if index in errors:
+                    self.results.append({"index": index, "calculation_status": "error", "message": errors[index], "output_file": None, "time_spent": time_spent, "saving_status": None})
+                    log.warning("Failed to calculate index: %s", index)
+                else:
+                    self.results.append({"index": index, "calculation_status": "success", "message": None, "output_file": output_file, "time_spent": time_spent, "saving_status": "success"})
+                    log.info("Successfully calculated index: %s in %.2f seconds", index, time_spent)
+        except Exception as e:
+            time_spent = time.time() - start_time
+            self.results = [{"index": index, "calculation_status": "exception", "message": str(e), "output_file": None, "time_spent": time_spent, "saving_status": None} for index in self.indices]
+            log.critical("Error calculating indices %s: %s", ", ".join(self.indices), e)
+        finally:
+            self.setProgress(100)
+            if self.completion_event is not None:
+                self.completion_event.set()
+            return all(result["calculation_status"] == "success" for result in self.results)
+
+    def cancel(self):
+        log.warning("Task %s was canceled.", ", ".join(self.indices))
+        super().cancel()
+
+    def finished(self, success):
+        if success:
+            log.info("%s", self.results)
+        else:
+            log.warning("%s", self.results)
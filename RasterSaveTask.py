@@ -1,86 +1,101 @@
-from RasterIndexCalculatorTask import RasterIndexCalculatorTask
+from RasterIndexCalculatorTask import RasterIndexCalculatorTask, COG_CREATION_OPTIONS
 from qgis.core import QgsTask
 import queue
 import logging
 import threading
+import os
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import gdal
 
+log = logging.getLogger(__name__)
+
 class RasterSaveTask(QgsTask):
-    def __init__(self, description="Raster Save Task"):
+    def __init__(self, description="Raster Save Task", completion_event: threading.Event=None, max_workers: int=min(4, os.cpu_count() or 1)):
         super().__init__(description, QgsTask.CanCancel)
         self.task_queue = queue.Queue()  # Thread-safe queue
         self.running = True  # Control flag
-        self.condition = threading.Condition()  # For efficient waiting
+        self.max_workers = max_workers  # Number of rasters saved in parallel, GDAL releases the GIL while saving
+        # The CPUs are split between the rasters saved in parallel instead of each compressing with all of them
+        self.creation_options = [option for option in COG_CREATION_OPTIONS if not option.startswith("NUM_THREADS=")] + [f"NUM_THREADS={max(1, (os.cpu_count() or 1) // max_workers)}"]
 
         self.__saved_rasters = []  # List of saved rasters
         self.lock = threading.Lock()  # Lock for thread-safe access
+        self.completion_event = completion_event  # Set whenever a raster has been saved
 
     def add_task(self, output_file, output_in_memory_file, estimated_size, description, result):
         """
-        Adds a new raster save task to the queue and notifies the waiting thread.
+        Adds a new raster save task to the queue.
         """
-        with self.condition:
-            self.task_queue.put((output_file, output_in_memory_file, estimated_size, description, result))
-            self.condition.notify()  # Wake up the worker if it's waiting
+        self.task_queue.put((output_file, output_in_memory_file, estimated_size, description, result))
 
     def add_tasks(self, tasks: list[RasterIndexCalculatorTask]):
         """
-        Adds new raster save tasks to the queue and notifies the waiting thread.
+        Adds new raster save tasks to the queue.
         """
-        with self.condition:
-            for task in tasks:
-                self.task_queue.put((task.output_file, task.output_in_memory_file, task.total_memory_usage, task.description(), task.result))
-            
-            self.condition.notify()  # Wake up the worker if it's waiting
-
+        for task in tasks:
+            self.task_queue.put((task.output_file, task.output_in_memory_file, task.total_memory_usage, task.description(), task.result))
 
     def run(self):
         """
-        Waits for new raster save tasks and processes them efficiently.
+        Waits for new raster save tasks and saves them in batches: every task waiting in the queue
+        is taken at once and the batch is saved in parallel.
         """
-        logging.info("RasterSaveTask started.")
-        
-        while self.running:
-            with self.condition:
-                while self.task_queue.empty():
-                    if not self.running or self.isCanceled():
-                        logging.info("RasterSaveTask was canceled or stopped.")
-                        return False
-                    self.condition.wait()  # Block the thread until a new task is added
-
-            # Get the next task
-            output_file, output_in_memory_file, estimated_size, description, result = self.task_queue.get()
-
-            logging.debug(f"Saving task: {description}")
-            try:
-                gdal.Translate(output_file, output_in_memory_file)
-                logging.info(f"Successfully saved task: {description}")
-                result["saving_status"] = "success"
-
-            except Exception as e:
-                gdal.Unlink(output_in_memory_file)
-                logging.critical(f"Error saving task {description}: {e}")
-                result["saving_status"] = f"error - {e}"
-            finally:
-                # Safely update the saved rasters list
-                with self.lock:
-                    self.__saved_rasters.append({
-                        "total_saved_size": estimated_size,
-                        "description": description,
-                        "output_file": output_file,
-                        "result": result,
-                    })
-
-        logging.info("RasterSaveTask stopped.")
+        log.info("RasterSaveTask started.")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while self.running and not self.isCanceled():
+                try:
+                    batch = [self.task_queue.get(timeout=0.5)]  # Timeout to check regularly if the task was stopped
+                except queue.Empty:
+                    continue
+
+                while True:
+                    try:
+                        batch.append(self.task_queue.get_nowait())
+                    except queue.Empty:
+                        break
+
+                log.debug("Saving a batch of %s rasters", len(batch))
+                list(executor.map(self.__save_raster, batch))
+
+        if self.isCanceled():
+            log.info("RasterSaveTask was canceled.")
+            return False
+
+        log.info("RasterSaveTask stopped.")
         return True
 
+    def __save_raster(self, task):
+        output_file, output_in_memory_file, estimated_size, description, result = task
+
+        log.debug("Saving task: %s", description)
+        try:
+            gdal.Translate(output_file, output_in_memory_file, options=gdal.TranslateOptions(format="COG", creationOptions=self.creation_options))
+            log.info("Successfully saved task: %s", description)
+            result["saving_status"] = "success"
+            result["output_file"] = output_file
+
+        except Exception as e:
+            log.critical("Error saving task %s: %s", description, e)
+            result["saving_status"] = f"error - {e}"
+        finally:
+            gdal.Unlink(output_in_memory_file)  # Frees the in-memory raster once it has been copied
+            # Safely update the saved rasters list
+            with self.lock:
+                self.__saved_rasters.append({
+                    "total_saved_size": estimated_size,
+                    "description": description,
+                    "output_file": output_file,
+                    "result": result,
+                })
+            if self.completion_event is not None:
+                self.completion_event.set()
+
     def cancel(self):
         """
-        Stops the task gracefully and wakes up the waiting thread.
+        Stops the task gracefully, the worker exits after saving the batch in progress.
         """
-        with self.condition:
-            self.running = False
-            self.condition.notify_all()  # Wake up the waiting thread to allow exit
+        self.running = False
         super().cancel()
 
     def get_and_reset_saved_rasters(self):